@@ -1,6 +1,7 @@
 from .core import (
     load_sheet,
     load_reference,
+    clear_cache,
     create_annotations,
     create_display_matrix
 )
\ No newline at end of file
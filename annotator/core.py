@@ -1,9 +1,48 @@
+import functools
+import os
+import re
+
+import numba
+import numpy as np
 import pandas as pd
-from collections import Counter
+from scipy import sparse
+
+# pandas only understands the calamine engine from 2.2 onwards
+try:
+    import python_calamine  # noqa: F401
+    _PANDAS_VERSION = tuple(int(part) for part in re.findall(r"\d+", pd.__version__)[:2])
+    EXCEL_ENGINE = "calamine" if _PANDAS_VERSION >= (2, 2) else "openpyxl"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 
 SCORE_CUTOFF = 0.1
 LIMIT = 5
 
+@functools.lru_cache(maxsize=16)
+def _read_excel_cached(file_path, sheet_name, mtime):
+    return pd.read_excel(file_path, sheet_name=sheet_name, engine=EXCEL_ENGINE)
+
+def _read_excel(file_path, sheet_name):
+    """
+    Read a sheet from the Excel file, reusing the last read while the file is unchanged
+
+    The cache is keyed on the file's path and modification time, and callers get
+    a copy so they are free to modify it. Anything other than a local file (file
+    objects, URLs, fsspec paths) is handed to pd.read_excel uncached.
+    """
+    if isinstance(file_path, (str, os.PathLike)):
+        local_path = os.path.expanduser(file_path)
+        if os.path.isfile(local_path):
+            local_path = os.path.abspath(local_path)
+            return _read_excel_cached(local_path, sheet_name, os.path.getmtime(local_path)).copy()
+    return pd.read_excel(file_path, sheet_name=sheet_name, engine=EXCEL_ENGINE)
+
+def clear_cache():
+    """
+    Forget all sheets cached by load_sheet() and load_reference()
+    """
+    _read_excel_cached.cache_clear()
+
 def load_sheet(file_path, sheet_name=None):
     """
     Load the sheet from the Excel file
@@ -19,16 +58,18 @@ def load_sheet(file_path, sheet_name=None):
 
     is loaded even if it is not aligned exactly to the left.
     """
-    df = pd.read_excel(file_path, sheet_name=sheet_name or 'Integ summary')
+    df = _read_excel(file_path, sheet_name or 'Integ summary')
     
     # Find first column with purely numeric data or NaN
     start_idx = None
     length = 0
-    for col in df.columns:
-        data = pd.to_numeric(df[col], errors='coerce')
-        if all(isinstance(item, (int, float)) for item in data.to_list()) and not data.isna().all():
-            start_idx = df.columns.get_loc(col)
-            length = data.isna().idxmax() if data.isna().any() else len(data)
+    for idx in range(df.shape[1]):
+        # to_numeric(errors='coerce') only ever yields numbers or NaN, so the
+        # column qualifies as soon as it holds at least one value
+        missing = pd.to_numeric(df.iloc[:, idx], errors='coerce').isna()
+        if not missing.all():
+            start_idx = idx
+            length = missing.idxmax() if missing.any() else len(missing)
             break
     
     # Remove columns up to and including start_idx
@@ -51,52 +92,112 @@ def load_reference(file_path, sheet_name=None):
     The first column contains the cell type labels, and the remaining
     columns contain the number of integrations for each cell type.
     """
-    reference = pd.read_excel(file_path, sheet_name=sheet_name)
+    reference = _read_excel(file_path, sheet_name)
     reference = reference.iloc[:, ::2]
     return reference
 
-def _get_gene_counts(df):
+def _create_gene_codes(*frames):
+    """
+    Encode the genes in each dataframe as integer codes into the shared gene universe
+
+    Returns the universe (genes in order of first appearance) and an int32 code
+    array of the same shape as each dataframe, with -1 for empty cells.
+    """
+    values = [frame.to_numpy(dtype=object) for frame in frames]
+    codes, genes = pd.factorize(np.concatenate([value.ravel() for value in values]))
+    codes = codes.astype(np.int32)
+    splits = np.cumsum([value.size for value in values])[:-1]
+    return genes, [code.reshape(value.shape) for code, value in zip(np.split(codes, splits), values)]
+
+def _get_gene_counts(codes, n_genes):
+    """
+    Create a count for all genes in the coded dataframe
     """
-    Create a count for all genes in the dataframe
+    return np.bincount(codes[codes >= 0], minlength=n_genes)
+
+# Compiled eagerly for the one signature it is called with, and cached to disk,
+# so that neither import nor the first call pays for JIT compilation
+@numba.njit(
+    numba.types.Tuple((numba.int32[::1], numba.int32[::1], numba.float64[::1]))(
+        numba.int32[:, ::1], numba.float64[::1]
+    ),
+    cache=True,
+    fastmath=True,
+)
+def _marker_potential_coo(codes, counts_inv):
     """
-    return Counter(df.values.flatten())
+    Create (gene, cell type, marker potential) triples for every gene in codes
 
-def _create_marker_potential_matrix(reference, counts): 
+    codes holds the gene code for each entry of the sheet, or -1 for empty cells,
+    and counts_inv the reciprocal of each gene's count. A gene listed more than
+    once for a cell type keeps only its lowest entry.
     """
-    Create a matrix of the form:
+    n_rows, n_cols = codes.shape
+    size = 0
+    for col in range(n_cols):
+        for idx in range(n_rows):
+            if codes[idx, col] >= 0:
+                size += 1
+    rows = np.empty(size, dtype=np.int32)
+    cols = np.empty(size, dtype=np.int32)
+    vals = np.empty(size, dtype=np.float64)
+    rank_inv = 1 / np.arange(1, n_rows + 1, dtype=np.float64)
+    last_col = np.full(len(counts_inv), -1, dtype=np.int32)
+    nnz = 0
+    for col in range(n_cols):
+        for idx in range(n_rows - 1, -1, -1):
+            row = codes[idx, col]
+            if row >= 0 and last_col[row] != col:
+                last_col[row] = col
+                rows[nnz] = row
+                cols[nnz] = col
+                vals[nnz] = rank_inv[idx] * counts_inv[row]
+                nnz += 1
+    return rows[:nnz], cols[:nnz], vals[:nnz]
+
+def _create_marker_potential_matrix(codes, counts_inv):
+    """
+    Create a sparse matrix of the form:
 
               | Cell type 1 | Cell type 2 | ...
     Gene 1    | Marker potential
     Gene 2    | 
     ...
+
+    where the genes are given by the codes of the reference sheet.
     """
-    result_matrix = pd.DataFrame(0, index=counts.keys(), columns=reference.columns, dtype=float)
-    for col in reference.columns:
-        for idx, value in enumerate(reference[col]):
-            if pd.notna(value):
-                result_matrix.loc[str(value), col] = 1 / (1 + idx) / counts[value]
-    return result_matrix
+    rows, cols, vals = _marker_potential_coo(np.ascontiguousarray(codes), np.ascontiguousarray(counts_inv))
+    return sparse.csc_matrix((vals, (rows, cols)), shape=(len(counts_inv), codes.shape[1]))
 
-def _create_top_gene_scores(weightings, result_matrix, match_matrix, limit, level):
+def _create_top_gene_scores(weightings, genes, result_matrix, match_matrix, limit, level):
     """
     Create a dictionary of dataframes with top matching cell types and their top 10 gene scores.
     """
     limit = limit or weightings.shape[1]
+    result_matrix = result_matrix.toarray(order="F")
+    match_matrix = match_matrix.toarray(order="F")
+    result_cols = {name: idx for idx, name in enumerate(weightings.index)}
+    match_cols = {name: idx for idx, name in enumerate(weightings.columns)}
     results = {}
     for col in weightings.columns:
-        col_sorted = weightings[col].sort_values(ascending=False)
-        col_filtered = col_sorted[col_sorted >= SCORE_CUTOFF].head(LIMIT)
-        top_gene_scores_df = pd.DataFrame()
+        col_weightings = weightings[col]
+        col_filtered = col_weightings[col_weightings >= SCORE_CUTOFF].nlargest(LIMIT)
+        match_series_list = []
         max_genes = 0
+        match_col = match_matrix[:, match_cols[col]]
         for match in col_filtered.index:
-            scores = match_matrix[col] * result_matrix[match] * 100
-            top_genes = scores.sort_values(ascending=False)
-            top_genes = top_genes[top_genes > level].head(limit)
-            formatted_genes = [f"{gene} ({score:.2f})" for gene, score in top_genes.items()]
+            scores = match_col * result_matrix[:, result_cols[match]] * 100
+            # Partially select the top genes so that only those need sorting
+            top_idx = np.flatnonzero(scores > level)
+            if top_idx.size > limit:
+                top_idx = top_idx[np.argpartition(-scores[top_idx], limit)[:limit]]
+            top_idx = top_idx[np.argsort(-scores[top_idx], kind="stable")]
+            formatted_genes = [f"{gene} ({score:.2f})" for gene, score in zip(genes[top_idx], scores[top_idx])]
             match_series = pd.Series(formatted_genes, name=match)
             match_series = match_series.reindex(range(limit), fill_value="")
-            top_gene_scores_df = pd.concat([top_gene_scores_df, match_series], axis=1)
+            match_series_list.append(match_series)
             max_genes = max(max_genes, len(formatted_genes))
+        top_gene_scores_df = pd.concat(match_series_list, axis=1) if match_series_list else pd.DataFrame()
         results[col] = top_gene_scores_df.reindex(range(max_genes), fill_value="")
     return results
 
@@ -115,13 +216,16 @@ def create_annotations(reference, df, limit=None, level=0):
             - weightings: DataFrame containing cell type match percentages
             - top_gene_scores: Dictionary of DataFrames with top matching genes
     """
-    counts = _get_gene_counts(reference)
-    counts.update({gene: 0 for gene in df.values.flatten() if gene not in counts})
-    result_matrix = _create_marker_potential_matrix(reference, counts)
-    match_matrix = _create_marker_potential_matrix(df, {gene: 1 for gene in counts})
-    weightings = result_matrix.transpose() @ match_matrix
+    genes, (reference_codes, df_codes) = _create_gene_codes(reference, df)
+    gene_counts = _get_gene_counts(reference_codes, len(genes))
+    counts_inv = np.divide(1, gene_counts, out=np.zeros(len(genes)), where=gene_counts > 0)
+    result_matrix = _create_marker_potential_matrix(reference_codes, counts_inv)
+    match_matrix = _create_marker_potential_matrix(df_codes, np.ones(len(genes)))
+    # The percentages are rounded to 2 decimal places, so a single precision product is ample
+    weightings = (result_matrix.astype(np.float32).T @ match_matrix.astype(np.float32)).toarray()
+    weightings = pd.DataFrame(weightings, index=reference.columns, columns=df.columns, dtype=np.float64)
     weightings = weightings.div(weightings.sum(axis=0), axis=1).mul(100).round(2)
-    return weightings, _create_top_gene_scores(weightings, result_matrix, match_matrix, limit, level)
+    return weightings, _create_top_gene_scores(weightings, genes, result_matrix, match_matrix, limit, level)
 
 def create_display_matrix(weightings, level=SCORE_CUTOFF):
     """
@@ -133,15 +237,14 @@ def create_display_matrix(weightings, level=SCORE_CUTOFF):
     Returns:
         pd.DataFrame: Formatted display matrix showing top matches with percentages
     """
-    result_df = pd.DataFrame()
+    formatted = {}
     for col in weightings.columns:
-        col_sorted = weightings[col].sort_values(ascending=False)
-        col_filtered = col_sorted[col_sorted >= level].head(LIMIT)
+        col_weightings = weightings[col]
+        col_filtered = col_weightings[col_weightings >= level].nlargest(LIMIT)
         formatted_series = pd.Series(
             [f"{idx} ({val}%)" for idx, val in col_filtered.items()],
             name=col,
             dtype=str
         )
-        formatted_series = formatted_series.reindex(range(5), fill_value="")
-        result_df = pd.concat([result_df, formatted_series], axis=1)
-    return result_df 
+        formatted[col] = formatted_series.reindex(range(5), fill_value="")
+    return pd.DataFrame(formatted)
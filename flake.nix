@@ -18,9 +18,12 @@
             appimage-run
             python3
             venvShellHook
+            numba
             numpy
             pandas
             openpyxl
+            scipy
+            python-calamine
           ];
         };
   });
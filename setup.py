@@ -5,9 +5,15 @@ setup(
     version="0.2.0",
     packages=find_packages(),
     install_requires=[
+        "numba",
+        "numpy",
         "pandas",
+        "scipy",
         "openpyxl",
     ],
+    extras_require={
+        "calamine": ["pandas>=2.2", "python-calamine"],
+    },
     author="James Reynolds",
     author_email="james@groundupwards.com",
     description="A library for annotating cell types based on gene expression data",